@@ -16,10 +16,14 @@ from __future__ import print_function
 import json
 import os
 import platform
+import subprocess
+
+import yaml
 
 from charms import reactive
 
-from charmhelpers.core import hookenv
+from charmhelpers import fetch
+from charmhelpers.core import hookenv, unitdata
 
 from spcharms import config as spconfig
 from spcharms import error as sperror
@@ -32,9 +36,26 @@ from spcharms.run import storpool_openstack_integration as run_osi
 
 RELATIONS = ['cinder-p', 'storpool-presence']
 
+PREFETCH_PACKAGES = ['storpool-openstack-integration']
+PREFETCH_KEY = 'cinder-storpool.prefetched'
+APT_ARCHIVES = '/var/cache/apt/archives'
+
+QOS_KEYS = [
+    'total_bytes_sec', 'read_bytes_sec', 'write_bytes_sec',
+    'total_iops_sec', 'read_iops_sec', 'write_iops_sec',
+]
+
 
 sp_node = platform.node()
 
+# The relation writes collected during the current hook, flushed at its end
+published = {
+    'relations': {},
+    'presence': None,
+    'requests': 0,
+    'registered': False,
+}
+
 
 def rdebug(s, cond=None):
     """
@@ -43,6 +64,74 @@ def rdebug(s, cond=None):
     sputils.rdebug(s, prefix='cinder-charm', cond=cond)
 
 
+def register_flush():
+    """
+    Make sure the collected relation writes are sent at the end of
+    the current hook.
+    """
+    if not published['registered']:
+        published['registered'] = True
+        hookenv.atexit(flush_published)
+
+
+def publish(rel_id, **settings):
+    """
+    Schedule a `relation-set` call, merging it with any settings already
+    queued for the same relation during this hook.
+    """
+    register_flush()
+    published['requests'] += 1
+    published['relations'].setdefault(rel_id, {}).update(settings)
+
+
+def publish_presence(data):
+    """
+    Schedule the sending of our presence data; only the last version
+    queued during this hook will actually be sent.
+    """
+    register_flush()
+    published['requests'] += 1
+    published['presence'] = data
+
+
+def flush_published():
+    """
+    Send out all the relation writes collected during this hook,
+    one `relation-set` invocation for each relation.
+
+    The presence data is still sent by `service_hook.send_presence()`,
+    which owns its wire format and writes (and encodes) it separately to
+    each of the `RELATIONS` relation ids; it is only sent once per hook,
+    though, and those writes are counted too.
+    """
+    relations = published['relations']
+    presence = published['presence']
+    requests = published['requests']
+    published['relations'] = {}
+    published['presence'] = None
+    published['requests'] = 0
+    published['registered'] = False
+
+    pres_writes = 0
+    if presence is not None:
+        rdebug('announcing {data}'.format(data=presence), cond='announce')
+        pres_writes = sum(len(hookenv.relation_ids(name))
+                          for name in RELATIONS)
+        service_hook.send_presence(presence, RELATIONS)
+    for rel_id, settings in sorted(relations.items()):
+        hookenv.relation_set(rel_id, **settings)
+        rdebug('- sent it along {rel}'.format(rel=rel_id))
+
+    writes = len(relations) + pres_writes
+    if writes:
+        hookenv.log('Published {writes} relation writes for {req} requests '
+                    '({rels} relation settings, {pres} presence writes '
+                    'by service_hook.send_presence())'
+                    .format(writes=writes, req=requests, rels=len(relations),
+                            pres=pres_writes),
+                    hookenv.INFO)
+
+
 @reactive.hook('install')
 def install():
     """
@@ -64,6 +153,7 @@ def config_changed():
 @reactive.hook('post-series-upgrade')
 def post_series_upgrade():
     """ Try to upgrade everything. """
+    install_prefetched()
     reactive.set_state('cinder-storpool.run')
     update_status()
 
@@ -88,6 +178,10 @@ def configure():
         return
 
     rdebug('we have the {template} template now'.format(template=template))
+    vtypes = check_volume_types(config)
+    if vtypes is None:
+        return
+    rdebug('volume types: {vt}'.format(vt=sorted(vtypes.keys())))
     reactive.set_state('cinder-storpool.configured')
     update_status()
 
@@ -122,6 +216,85 @@ def try_announce():
         exit(42)
 
 
+def get_volume_types(config):
+    """
+    Parse the "storpool_volume_types" setting into a dictionary of
+    Cinder volume types, each with the extra specs that bind it to
+    a StorPool template and, optionally, front-end QoS specs.
+    Raise a ValueError if the setting is malformed.
+    """
+    raw = config.get('storpool_volume_types', None)
+    if raw is None or raw == '':
+        return {}
+    try:
+        parsed = yaml.safe_load(raw)
+    except yaml.YAMLError as e:
+        raise ValueError('not valid YAML: {e}'.format(e=e))
+    if parsed is None:
+        return {}
+    if not isinstance(parsed, dict):
+        raise ValueError('not a mapping of volume types')
+
+    service = hookenv.service_name()
+    res = {}
+    for name, vdata in sorted(parsed.items()):
+        if not isinstance(name, str) or name == '':
+            raise ValueError('invalid volume type name {n!r}'.format(n=name))
+        if isinstance(vdata, str):
+            vdata = {'template': vdata}
+        elif not isinstance(vdata, dict):
+            raise ValueError('{n}: not a template name or a mapping'
+                             .format(n=name))
+        unknown = sorted(set(vdata.keys()) - set(['template', 'qos']))
+        if unknown:
+            raise ValueError('{n}: unknown keys {u}'.format(n=name, u=unknown))
+
+        template = vdata.get('template')
+        if not isinstance(template, str) or template == '':
+            raise ValueError('{n}: no StorPool template'.format(n=name))
+        vtype = {
+            'extra_specs': {
+                'volume_backend_name': service,
+                'storpool_template': template,
+            },
+        }
+
+        qos = vdata.get('qos')
+        if qos is not None:
+            if not isinstance(qos, dict) or not qos:
+                raise ValueError('{n}: "qos" must be a non-empty mapping'
+                                 .format(n=name))
+            unknown = sorted(set(qos.keys()) - set(QOS_KEYS))
+            if unknown:
+                raise ValueError('{n}: unknown QoS keys {u}'
+                                 .format(n=name, u=unknown))
+            bad = sorted(key for key, value in qos.items()
+                         if not isinstance(value, int) or
+                         isinstance(value, bool) or value <= 0)
+            if bad:
+                raise ValueError('{n}: QoS values must be positive '
+                                 'integers: {b}'.format(n=name, b=bad))
+            specs = {'consumer': 'front-end'}
+            specs.update((key, str(value)) for key, value in qos.items())
+            vtype['qos_specs'] = specs
+
+        res[name] = vtype
+    return res
+
+
+def check_volume_types(config):
+    """
+    Parse the "storpool_volume_types" setting, logging an error and
+    returning None if it is malformed.
+    """
+    try:
+        return get_volume_types(config)
+    except ValueError as e:
+        hookenv.log('Invalid "storpool_volume_types" setting: {e}'
+                    .format(e=e), hookenv.ERROR)
+        return None
+
+
 def build_presence(current):
     current['hostname'] = platform.node()
 
@@ -206,9 +379,7 @@ def announce_presence(force=False):
                 },
             },
         }
-        rdebug('announcing {data}'.format(data=data),
-               cond='announce')
-        service_hook.send_presence(data, RELATIONS)
+        publish_presence(data)
 
 
 @reactive.when('storage-backend.configure')
@@ -222,6 +393,11 @@ def storage_backend_configure(*args, **kwargs):
     have the configuration for the "cinder-storpool" volume backend.
     """
     rdebug('configuring cinder and stuff')
+    vtypes = check_volume_types(hookenv.config())
+    if vtypes is None:
+        update_status()
+        return
+
     service = hookenv.service_name()
     data = {
         'cinder': {
@@ -239,14 +415,15 @@ def storage_backend_configure(*args, **kwargs):
             },
         },
     }
+    if vtypes:
+        data['volume_types'] = vtypes
     rdebug('configure setting some data: {data}'.format(data=data))
-    rel_ids = hookenv.relation_ids('storage-backend')
-    for rel_id in rel_ids:
-        hookenv.relation_set(rel_id,
-                             backend_name=hookenv.service_name(),
-                             subordinate_configuration=json.dumps(data),
-                             stateless=True)
-        rdebug('- sent it along {rel}'.format(rel=rel_id))
+    encoded = json.dumps(data)
+    for rel_id in hookenv.relation_ids('storage-backend'):
+        publish(rel_id,
+                backend_name=service,
+                subordinate_configuration=encoded,
+                stateless=True)
     reactive.set_state('cinder-storpool.ready')
     update_status()
 
@@ -257,6 +434,7 @@ def upgrade():
     """
     Try to (re-)install everything.
     """
+    install_prefetched()
     reactive.set_state('cinder-storpool.run')
     update_status()
 
@@ -282,11 +460,15 @@ def get_status():
     }
 
     status['presence'] = service_hook.fetch_presence(RELATIONS)
+    status['prefetched'] = unitdata.kv().get(PREFETCH_KEY, {})
     parent_name = 'block:' + status['parent-node']
 
-    template = status['charm-config'].get('storpool_template')
+    template = status['charm-config'].get('storpool_template', None)
+    vtypes = check_volume_types(status['charm-config'])
     msg = None
-    if not status['cinder-hook']:
+    if vtypes is None:
+        msg = 'Invalid "storpool_volume_types" setting, see the unit log'
+    elif not status['cinder-hook']:
         msg = 'No Cinder hook yet'
     elif parent_name not in status['presence']['nodes']:
         msg = 'No presence data from our parent node'
@@ -294,6 +476,8 @@ def get_status():
         msg = 'No "storpool_template" in the charm config'
     elif not reactive.is_state('cinder-storpool.ready'):
         msg = 'Something went wrong, please look at the unit log'
+    if vtypes is not None:
+        status['volume-types'] = vtypes
     if msg is not None:
         status['message'] = msg
         return status
@@ -364,6 +548,159 @@ def sp_status():
         hookenv.action_fail(s)
 
 
+def get_candidate_versions():
+    """
+    Fetch the versions of the StorPool integration packages that
+    the next installation or upgrade would pick from the apt sources.
+    """
+    output = subprocess.check_output(
+        ['env', 'LC_ALL=C', 'apt-cache', 'policy', '--'] + PREFETCH_PACKAGES)
+    res = {}
+    pkg = None
+    for line in output.decode().split('\n'):
+        if line and not line[0].isspace() and line.endswith(':'):
+            pkg = line[:-1]
+        elif pkg is not None and line.strip().startswith('Candidate:'):
+            version = line.split(':', 1)[1].strip()
+            if version != '(none)':
+                res[pkg] = version
+            pkg = None
+    return res
+
+
+def prefetched_file(pkg, version):
+    """
+    Look for a package file in the local apt cache, whatever its
+    architecture.
+    """
+    prefix = '{pkg}_{ver}_'.format(pkg=pkg,
+                                   ver=version.replace(':', '%3a'))
+    try:
+        names = os.listdir(APT_ARCHIVES)
+    except OSError:
+        return None
+    for name in names:
+        if name.startswith(prefix) and name.endswith('.deb'):
+            return os.path.join(APT_ARCHIVES, name)
+    return None
+
+
+def is_staged(pkg, version):
+    """
+    Check whether the specified version of a package is either already
+    installed or present in the local apt cache.
+    """
+    installed = fetch.get_installed_version(pkg)
+    if installed is not None and installed.ver_str == version:
+        return True
+    return prefetched_file(pkg, version) is not None
+
+
+def prefetch(refresh=True, fatal=True):
+    """
+    Download (but do not install) the StorPool integration packages into
+    the local apt cache so that a later upgrade does not have to wait for
+    the mirrors.  Record the versions that have been staged.
+
+    If `refresh` is set, update the apt package lists first so that
+    the staged versions are the ones an upgrade would pick.  If `fatal`
+    is set, retry the apt commands if the dpkg lock is held.
+
+    Note that only the versions of the `PREFETCH_PACKAGES` themselves
+    are checked when deciding whether anything needs to be downloaded;
+    any new dependencies fetched by an earlier run are assumed to still
+    be in the cache.  If they are not, `install_prefetched()` will fail
+    instead of downloading them.
+    """
+    if refresh:
+        fetch.apt_update(fatal=fatal)
+
+    kv = unitdata.kv()
+    candidates = get_candidate_versions()
+    missing = sorted(pkg for pkg in PREFETCH_PACKAGES
+                     if pkg not in candidates)
+    if missing:
+        raise sperror.StorPoolException(
+            'No installation candidate for {names}'
+            .format(names=' '.join(missing)))
+
+    if kv.get(PREFETCH_KEY) == candidates and \
+            all(is_staged(pkg, ver) for pkg, ver in candidates.items()):
+        rdebug('already prefetched {c}'.format(c=candidates),
+               cond='prefetch')
+        return candidates
+
+    wanted = sorted('{pkg}={ver}'.format(pkg=pkg, ver=ver)
+                    for pkg, ver in candidates.items()
+                    if not is_staged(pkg, ver))
+    if wanted:
+        rdebug('prefetching {w}'.format(w=' '.join(wanted)))
+        fetch.apt_install(wanted,
+                          options=['--download-only',
+                                   '--no-install-recommends'],
+                          fatal=fatal, quiet=True)
+
+    bad = sorted(pkg for pkg, ver in candidates.items()
+                 if not is_staged(pkg, ver))
+    if bad:
+        raise sperror.StorPoolException(
+            'Could not find the prefetched {names} packages in {d}'
+            .format(names=' '.join(bad), d=APT_ARCHIVES))
+
+    kv.set(PREFETCH_KEY, candidates)
+    rdebug('prefetched {c}'.format(c=candidates))
+    return candidates
+
+
+def install_prefetched():
+    """
+    Before an upgrade, install the StorPool packages staged by
+    `prefetch()` from the local apt cache only.  Refuse to go on if
+    the staged versions are not the ones that would be installed.
+    """
+    staged = unitdata.kv().get(PREFETCH_KEY, {})
+    if not staged:
+        rdebug('no StorPool packages have been prefetched')
+        return
+
+    try:
+        candidates = get_candidate_versions()
+        if candidates != staged:
+            raise sperror.StorPoolException(
+                'the prefetched packages {staged} do not match the ones '
+                'to be installed: {c}; please rerun the sp-prefetch action'
+                .format(staged=staged, c=candidates))
+        wanted = sorted('{pkg}={ver}'.format(pkg=pkg, ver=ver)
+                        for pkg, ver in staged.items())
+        rdebug('installing the prefetched {w}'.format(w=' '.join(wanted)))
+        fetch.apt_install(wanted,
+                          options=['--no-download',
+                                   '--no-install-recommends',
+                                   '--option=Dpkg::Options::=--force-confold'],
+                          fatal=True)
+    except (sperror.StorPoolException, OSError,
+            subprocess.CalledProcessError) as e:
+        s = 'Could not install the prefetched StorPool packages: {e}' \
+            .format(e=e)
+        hookenv.log(s, hookenv.ERROR)
+        hookenv.status_set('blocked', s)
+        exit(42)
+
+
+@reactive.when('cinder-storpool.sp-prefetch')
+def sp_prefetch():
+    # Yes, removing it at once, not after the fact.  If something
+    # goes wrong, the action may be reissued.
+    reactive.remove_state('cinder-storpool.sp-prefetch')
+    try:
+        staged = prefetch()
+        hookenv.action_set({'prefetched': json.dumps(staged)})
+    except BaseException as e:
+        s = 'Could not prefetch the StorPool packages: {e}'.format(e=e)
+        hookenv.log(s, hookenv.ERROR)
+        hookenv.action_fail(s)
+
+
 @reactive.when('cinder-storpool.run')
 @reactive.when('storpool-presence.configured')
 def run(reraise=False):
@@ -407,6 +744,25 @@ def run(reraise=False):
 
 
 @reactive.hook('update-status')
+def update_status_hook():
+    """
+    Prefetch the StorPool packages while idle if so configured, then
+    report the unit's status.
+
+    The idle prefetch does not refresh the apt package lists and does not
+    wait for the dpkg lock, so as not to get in the way of the principal
+    charm's package operations.
+    """
+    if hookenv.config().get('storpool_prefetch', False) and \
+            not reactive.is_state('cinder-storpool-charm.stopped'):
+        try:
+            prefetch(refresh=False, fatal=False)
+        except BaseException as e:
+            hookenv.log('Could not prefetch the StorPool packages: {e}'
+                        .format(e=e), hookenv.WARNING)
+    update_status()
+
+
 def update_status():
     try:
         status = get_status()
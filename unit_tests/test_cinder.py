@@ -12,6 +12,7 @@ import json
 import mock
 
 from charmhelpers.core import hookenv
+from charmhelpers.fetch import ubuntu_apt_pkg
 
 root_path = os.path.realpath('.')
 if root_path not in sys.path:
@@ -22,6 +23,7 @@ if lib_path not in sys.path:
     sys.path.insert(0, lib_path)
 
 from spcharms import config as spconfig
+from spcharms import error as sperror
 
 
 class MockReactive(object):
@@ -138,6 +140,41 @@ CONFIG_DATA = {
     },
 }
 CONFIG_JSON = json.dumps(CONFIG_DATA)
+OSI_PACKAGE = 'storpool-openstack-integration'
+OSI_VERSION = '1:1.5.0-1'
+OSI_FILE = 'storpool-openstack-integration_1%3a1.5.0-1_all.deb'
+VOLUME_TYPES_CONFIG = '''
+gold:
+  template: ssd
+  qos:
+    total_iops_sec: 5000
+    total_bytes_sec: 209715200
+bulk: hdd
+'''
+VOLUME_TYPES_DATA = {
+    'gold': {
+        'extra_specs': {
+            'volume_backend_name': SERVICE_NAME,
+            'storpool_template': 'ssd',
+        },
+        'qos_specs': {
+            'consumer': 'front-end',
+            'total_iops_sec': '5000',
+            'total_bytes_sec': '209715200',
+        },
+    },
+    'bulk': {
+        'extra_specs': {
+            'volume_backend_name': SERVICE_NAME,
+            'storpool_template': 'hdd',
+        },
+    },
+}
+APT_POLICY = '''storpool-openstack-integration:
+  Installed: 1:1.4.0-1
+  Candidate: 1:1.5.0-1
+  Version table:
+'''.encode()
 
 
 class TestCinderStorPoolCharm(unittest.TestCase):
@@ -194,8 +231,11 @@ class TestCinderStorPoolCharm(unittest.TestCase):
                               'cinder-storpool.ready',
                               ]), r_state.r_get_states())
 
-        self.assertEquals(2, h_sname.call_count)
+        self.assertEquals(1, h_sname.call_count)
         h_relids.assert_called_once_with(RELATION_NAME)
+        h_relset.assert_not_called()
+
+        testee.flush_published()
         h_relset.assert_called_once_with(RELATION_ID,
                                          backend_name=SERVICE_NAME,
                                          subordinate_configuration=CONFIG_JSON,
@@ -238,3 +278,296 @@ class TestCinderStorPoolCharm(unittest.TestCase):
         self.do_test_no_config()
         self.do_test_config()
         self.do_test_final_configure(h_sname, h_relids, h_relset, h_status)
+
+    @mock.patch('charmhelpers.core.hookenv.service_name')
+    def test_volume_types(self, h_sname):
+        """
+        Test the parsing of the volume type to StorPool template mapping.
+        """
+        h_sname.return_value = SERVICE_NAME
+        self.assertEqual({}, testee.get_volume_types(r_env_config))
+
+        r_env_config.r_set('storpool_volume_types', VOLUME_TYPES_CONFIG, True)
+        self.assertEqual(VOLUME_TYPES_DATA,
+                         testee.get_volume_types(r_env_config))
+
+        for bad in (
+            '[gold, bulk]',
+            'gold: {}',
+            'gold: {template: ssd, iops: 5}',
+            'gold: {template: ssd, qos: {iops: 5}}',
+            'gold: {template: ssd, qos: {total_iops_sec: -5}}',
+            'gold: {template: ssd, qos: {total_iops_sec: fast}}',
+            'gold: [',
+        ):
+            r_env_config.r_set('storpool_volume_types', bad, True)
+            self.assertRaises(ValueError, testee.get_volume_types,
+                              r_env_config)
+
+    @mock_reactive_states
+    @mock.patch('charmhelpers.core.hookenv.log')
+    def test_config_invalid_volume_types(self, h_log):
+        """
+        An invalid volume types setting keeps the charm unconfigured.
+        """
+        r_env_config.r_set('storpool_template', TEMPLATE_NAME, True)
+        r_env_config.r_set('storpool_volume_types', 'gold: [', True)
+        testee.configure()
+        self.assertEqual(set(), r_state.r_get_states())
+        self.assertIn('storpool_volume_types', h_log.call_args[0][0])
+
+    @mock_reactive_states
+    @mock.patch('charmhelpers.core.hookenv.status_set')
+    @mock.patch('charmhelpers.core.hookenv.relation_set')
+    @mock.patch('charmhelpers.core.hookenv.relation_ids')
+    @mock.patch('charmhelpers.core.hookenv.service_name')
+    def test_final_configure_volume_types(self, h_sname, h_relids, h_relset,
+                                          h_status):
+        """
+        Test the passing of the volume types to Cinder.
+        """
+        r_env_config.r_set('storpool_template', TEMPLATE_NAME, False)
+        r_env_config.r_set('storpool_volume_types', VOLUME_TYPES_CONFIG,
+                           False)
+        r_state.r_set_states(set(['cinder-storpool.configured']))
+        h_sname.return_value = SERVICE_NAME
+        h_relids.return_value = [RELATION_ID]
+
+        testee.storage_backend_configure(None)
+        self.assertEqual(set([
+                             'cinder-storpool.configured',
+                             'cinder-storpool.ready',
+                             ]), r_state.r_get_states())
+
+        testee.flush_published()
+        h_relset.assert_called_once_with(RELATION_ID,
+                                         backend_name=SERVICE_NAME,
+                                         subordinate_configuration=mock.ANY,
+                                         stateless=True)
+        expected = json.loads(CONFIG_JSON)
+        expected['volume_types'] = VOLUME_TYPES_DATA
+        self.assertEqual(expected, json.loads(
+            h_relset.call_args[1]['subordinate_configuration']))
+
+    @mock_reactive_states
+    @mock.patch('charmhelpers.core.hookenv.log')
+    @mock.patch('charmhelpers.core.hookenv.status_set')
+    @mock.patch('charmhelpers.core.hookenv.relation_set')
+    @mock.patch('charmhelpers.core.hookenv.relation_ids')
+    @mock.patch('charmhelpers.core.hookenv.service_name')
+    def test_final_configure_invalid_volume_types(self, h_sname, h_relids,
+                                                  h_relset, h_status, h_log):
+        """
+        An invalid volume types setting keeps the backend from being
+        announced even if the charm was configured before.
+        """
+        r_env_config.r_set('storpool_template', TEMPLATE_NAME, False)
+        r_env_config.r_set('storpool_volume_types', 'gold: [', True)
+        r_state.r_set_states(set(['cinder-storpool.configured']))
+        h_sname.return_value = SERVICE_NAME
+        h_relids.return_value = [RELATION_ID]
+
+        testee.storage_backend_configure(None)
+        self.assertEqual(set(['cinder-storpool.configured']),
+                         r_state.r_get_states())
+        testee.flush_published()
+        h_relset.assert_not_called()
+
+    @mock_reactive_states
+    @mock.patch('charmhelpers.core.hookenv.log')
+    @mock.patch('charmhelpers.core.unitdata.kv')
+    @mock.patch('charmhelpers.core.hookenv.service_name')
+    def test_status_volume_types(self, h_sname, u_kv, h_log):
+        """
+        Test the reporting of the volume types in the status.
+        """
+        h_sname.return_value = SERVICE_NAME
+        r_env_config.r_set('storpool_template', TEMPLATE_NAME, False)
+        r_env_config.r_set('storpool_volume_types', VOLUME_TYPES_CONFIG,
+                           False)
+        with mock.patch.object(testee.service_hook, 'fetch_presence',
+                               return_value={'nodes': {}}), \
+                mock.patch.object(testee.sputils, 'get_parent_node',
+                                  return_value='parent'):
+            st = testee.get_status()
+            self.assertEqual(VOLUME_TYPES_DATA, st['volume-types'])
+            self.assertEqual('No Cinder hook yet', st['message'])
+
+            r_env_config.r_set('storpool_volume_types', 'gold: [', True)
+            st = testee.get_status()
+            self.assertNotIn('volume-types', st)
+            self.assertEqual('Invalid "storpool_volume_types" setting, '
+                             'see the unit log', st['message'])
+            self.assertIn('storpool_volume_types', h_log.call_args[0][0])
+            self.assertFalse(st['ready'])
+
+    @mock.patch('charmhelpers.core.hookenv.log')
+    @mock.patch('charmhelpers.core.hookenv.relation_ids')
+    @mock.patch('charmhelpers.core.hookenv.relation_set')
+    def test_publish(self, h_relset, h_relids, h_log):
+        """
+        Test the collecting of relation writes during a hook.
+        """
+        other_id = 'storage-backend.43'
+        presence = {'generation': 1, 'nodes': {}}
+        presence_ids = {
+            'cinder-p': ['cinder-p.1'],
+            'storpool-presence': ['storpool-presence.2',
+                                  'storpool-presence.3'],
+        }
+        h_relids.side_effect = lambda name: presence_ids[name]
+        with mock.patch.object(testee.service_hook,
+                               'send_presence') as s_send:
+            testee.publish_presence({'generation': 0, 'nodes': {}})
+            testee.publish(RELATION_ID, backend_name='old', stateless=True)
+            testee.publish(other_id, subordinate_configuration=CONFIG_JSON)
+            testee.publish_presence(presence)
+            testee.publish(RELATION_ID, backend_name=SERVICE_NAME)
+            h_relset.assert_not_called()
+            s_send.assert_not_called()
+
+            testee.flush_published()
+            s_send.assert_called_once_with(presence, testee.RELATIONS)
+            self.assertEqual([
+                mock.call(RELATION_ID, backend_name=SERVICE_NAME,
+                          stateless=True),
+                mock.call(other_id, subordinate_configuration=CONFIG_JSON),
+            ], h_relset.call_args_list)
+            self.assertIn('Published 5 relation writes for 5 requests '
+                          '(2 relation settings, 3 presence writes',
+                          h_log.call_args[0][0])
+
+            # Nothing more to send.
+            h_relset.reset_mock()
+            s_send.reset_mock()
+            testee.flush_published()
+            h_relset.assert_not_called()
+            s_send.assert_not_called()
+
+    @mock.patch('charmhelpers.core.unitdata.kv')
+    @mock.patch('charmhelpers.fetch.apt_update')
+    @mock.patch('charmhelpers.fetch.apt_install')
+    @mock.patch('charmhelpers.fetch.get_installed_version')
+    @mock.patch('os.listdir')
+    @mock.patch('subprocess.check_output')
+    def test_prefetch(self, s_output, o_listdir, f_installed, f_install,
+                      f_update, u_kv):
+        """
+        Test the downloading of the packages into the local cache.
+        """
+        kv = {}
+        u_kv.return_value.get.side_effect = \
+            lambda key, default=None: kv.get(key, default)
+        u_kv.return_value.set.side_effect = kv.__setitem__
+        s_output.return_value = APT_POLICY
+        f_installed.return_value = ubuntu_apt_pkg.Version(
+            {'ver_str': '1:1.4.0-1'})
+
+        # Nothing in the cache yet: download it.
+        o_listdir.side_effect = [[], [OSI_FILE]]
+        expected = {OSI_PACKAGE: OSI_VERSION}
+        self.assertEqual(expected, testee.prefetch())
+        f_update.assert_called_once_with(fatal=True)
+        f_install.assert_called_once_with(
+            ['{pkg}={ver}'.format(pkg=OSI_PACKAGE, ver=OSI_VERSION)],
+            options=['--download-only', '--no-install-recommends'],
+            fatal=True, quiet=True)
+        self.assertEqual({testee.PREFETCH_KEY: expected}, kv)
+
+        # Already there, do not download it again.
+        f_install.reset_mock()
+        o_listdir.side_effect = None
+        o_listdir.return_value = [OSI_FILE]
+        self.assertEqual(expected, testee.prefetch())
+        f_install.assert_not_called()
+
+        # The download did not leave the file in the cache.
+        kv.clear()
+        o_listdir.return_value = []
+        self.assertRaises(sperror.StorPoolException, testee.prefetch)
+        self.assertEqual({}, kv)
+
+        # Not installed at all, not in the cache either.
+        f_installed.return_value = None
+        self.assertRaises(sperror.StorPoolException, testee.prefetch)
+        self.assertEqual({}, kv)
+
+        # The candidate is already installed, but the cache was cleaned.
+        f_install.reset_mock()
+        f_installed.return_value = ubuntu_apt_pkg.Version(
+            {'ver_str': OSI_VERSION})
+        self.assertEqual(expected, testee.prefetch())
+        f_install.assert_not_called()
+        self.assertEqual({testee.PREFETCH_KEY: expected}, kv)
+        u_kv.return_value.flush.assert_not_called()
+
+        # The idle prefetch neither refreshes the lists nor waits for locks.
+        kv.clear()
+        f_update.reset_mock()
+        f_installed.return_value = None
+        o_listdir.side_effect = [[], [OSI_FILE]]
+        self.assertEqual(expected, testee.prefetch(refresh=False,
+                                                   fatal=False))
+        f_update.assert_not_called()
+        f_install.assert_called_once_with(
+            ['{pkg}={ver}'.format(pkg=OSI_PACKAGE, ver=OSI_VERSION)],
+            options=['--download-only', '--no-install-recommends'],
+            fatal=False, quiet=True)
+
+    @mock.patch('charmhelpers.core.hookenv.log')
+    @mock.patch('charmhelpers.core.hookenv.status_set')
+    @mock.patch('charmhelpers.core.unitdata.kv')
+    @mock.patch('charmhelpers.fetch.apt_install')
+    @mock.patch('subprocess.check_output')
+    def test_install_prefetched(self, s_output, f_install, u_kv, h_status,
+                                h_log):
+        """
+        Test the installation of the prefetched packages before upgrades.
+        """
+        kv = {}
+        u_kv.return_value.get.side_effect = \
+            lambda key, default=None: kv.get(key, default)
+        s_output.return_value = APT_POLICY
+
+        # Nothing prefetched, nothing to do.
+        testee.install_prefetched()
+        f_install.assert_not_called()
+
+        # Install the staged versions without downloading anything.
+        kv[testee.PREFETCH_KEY] = {OSI_PACKAGE: OSI_VERSION}
+        testee.install_prefetched()
+        f_install.assert_called_once_with(
+            ['{pkg}={ver}'.format(pkg=OSI_PACKAGE, ver=OSI_VERSION)],
+            options=['--no-download', '--no-install-recommends',
+                     '--option=Dpkg::Options::=--force-confold'],
+            fatal=True)
+        h_status.assert_not_called()
+
+        # A newer version has appeared since; refuse to upgrade.
+        f_install.reset_mock()
+        kv[testee.PREFETCH_KEY] = {OSI_PACKAGE: '1:1.4.5-1'}
+        self.assertRaises(SystemExit, testee.install_prefetched)
+        f_install.assert_not_called()
+        self.assertEqual('blocked', h_status.call_args[0][0])
+
+    @mock_reactive_states
+    @mock.patch('charmhelpers.core.hookenv.status_set')
+    def test_update_status_prefetch(self, h_status):
+        """
+        The idle prefetch only runs if configured and not stopped.
+        """
+        with mock.patch.object(testee, 'prefetch') as t_prefetch, \
+                mock.patch.object(testee, 'get_status',
+                                  return_value={'message': 'm'}), \
+                mock.patch('charms.reactive.is_state', new=r_state.is_state):
+            testee.update_status_hook()
+            t_prefetch.assert_not_called()
+
+            r_env_config.r_set('storpool_prefetch', True, True)
+            testee.update_status_hook()
+            t_prefetch.assert_called_once_with(refresh=False, fatal=False)
+
+            t_prefetch.reset_mock()
+            r_state.r_set_states(set(['cinder-storpool-charm.stopped']))
+            testee.update_status_hook()
+            t_prefetch.assert_not_called()